@@ -1,11 +1,24 @@
 import streamlit as st
 import streamlit.components.v1 as components 
 import pandas as pd
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gpxpy
-from shapely.geometry import Point, LineString
+import xml.etree.ElementTree as ET
+import shapely
+from shapely.geometry import LineString
 import folium
+from folium.plugins import FastMarkerCluster
 import datetime
+import io
+import contextlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # ==========================================
 # 0. 页面配置
@@ -16,8 +29,93 @@ st.title("🐻 熊出没安全地图 ")
 # ==========================================
 # 1. 数据抽取 (合并三个年度)
 # ==========================================
-@st.cache_data
+# 共用 HTTP 会话: 连接池 + keep-alive 复用 TLS 握手, 临时故障自动重试
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
+# 清洗后数据的本地 Parquet 快照, 进程重启后无需重新请求 API
+SNAPSHOT_PATH = Path(__file__).parent / ".cache" / "yamanashi.parquet"
+SNAPSHOT_MAX_AGE = 24 * 3600  # 秒, 数据按天更新
+
+def to_naive_jst(parsed):
+    # 统一成不带时区的日本时间: 带时区的先换算到 JST 再去掉时区, 不带时区的按原样视为 JST
+    if isinstance(parsed, pd.Timestamp):
+        return parsed.tz_convert('Asia/Tokyo').tz_localize(None) if parsed.tzinfo else parsed
+    if parsed.dt.tz is not None:
+        return parsed.dt.tz_convert('Asia/Tokyo').dt.tz_localize(None)
+    return parsed
+
+def parse_datetime_column(values, fmt):
+    parsed = pd.to_datetime(values, format=fmt, errors='coerce')
+    if not pd.api.types.is_datetime64_any_dtype(parsed):
+        # pandas 2 遇到不一致的时区偏移不报错, 而是返回 object 列
+        raise ValueError("Mixed timezones detected")
+    return to_naive_jst(parsed)
+
+def parse_datetime_value(value):
+    for fmt in ('ISO8601', None):
+        parsed = pd.to_datetime(value, format=fmt, errors='coerce')
+        if not pd.isna(parsed):
+            return to_naive_jst(parsed)
+    return pd.NaT
+
+def parse_sighting_datetimes(values):
+    # 先按 ISO8601 固定格式整列解析 (CKAN 时间字段), 部分失败时只对失败的记录逐个推断格式
+    # 所有路径都是 errors='coerce' 语义, 且各年度资源都得到同一种 dtype (不带时区的日本时间), 合并后可直接比较
+    text = values.astype('string').str.strip()
+    present = text.notna() & (text != '')
+    try:
+        # 首个非空值不是 ISO 格式时整列直接推断, 避免每个值解析两遍
+        probe = pd.to_datetime(text[present].iloc[:1], format='ISO8601', errors='coerce')
+        if probe.isna().any():
+            return parse_datetime_column(values, None)
+        parsed = parse_datetime_column(values, 'ISO8601')
+        retry = parsed.isna() & present
+        if retry.any():
+            parsed[retry] = parse_datetime_column(values[retry], None)
+        return parsed
+    except (ValueError, TypeError):
+        # 时区偏移不一致, 或带时区与不带时区的记录混在一起: 逐个解析, 每个值单独换算到日本时间
+        return pd.to_datetime(pd.Series([parse_datetime_value(v) for v in values], index=values.index, dtype=object))
+
+def date_bounds(df):
+    # 返回 (最早日期, 最晚日期), 没有时间信息时为 (None, None)
+    valid_dates = df['sighting_datetime'].dropna()
+    if valid_dates.empty:
+        return None, None
+    return valid_dates.min().date(), valid_dates.max().date()
+
+def read_snapshot(max_age=None):
+    # 读取 Parquet 快照; 不存在、超过 max_age 或文件损坏时返回 None
+    try:
+        if max_age is not None and time.time() - SNAPSHOT_PATH.stat().st_mtime >= max_age:
+            return None
+        return pd.read_parquet(SNAPSHOT_PATH)
+    except Exception:
+        return None
+
+def write_snapshot(df):
+    # 先写临时文件再 os.replace 原子替换, 其他进程不会读到写了一半的快照
+    tmp_path = SNAPSHOT_PATH.with_name(f"{SNAPSHOT_PATH.name}.{os.getpid()}.tmp")
+    try:
+        SNAPSHOT_PATH.parent.mkdir(exist_ok=True)
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, SNAPSHOT_PATH)
+    except Exception:
+        # 只读文件系统等情况下跳过快照
+        with contextlib.suppress(OSError):
+            tmp_path.unlink(missing_ok=True)
+
 def load_yamanashi_data():
+    # 不单独缓存: 内存里只由 load_bear_catalog 的 cache_resource 持有一份, 跨进程靠 Parquet 快照
+    snapshot = read_snapshot(SNAPSHOT_MAX_AGE)
+    if snapshot is not None:
+        return snapshot
+
     url = "https://catalog.dataplatform-yamanashi.jp/api/action/datastore_search"
     
     # 包含最新和历史数据的 Resource ID 列表
@@ -27,23 +125,23 @@ def load_yamanashi_data():
         "89d2478e-e29e-46e3-9ad3-19bf44822d4d"  # 2022
     ]
     
-    all_frames = []
+    # 字段名映射
+    rename_map = {
+        '緯度': 'latitude', '纬度': 'latitude', 'Lat': 'latitude', 'LAT': 'latitude',
+        '経度': 'longitude', '经度': 'longitude', 'Lon': 'longitude', 'LON': 'longitude',
+        '年月日': 'sighting_datetime', '発生日時': 'sighting_datetime', 'Date': 'sighting_datetime'
+    }
+    desc_cols = ['目撃市町村', '場所', '住所', '詳細', '状況']
     
-    for rid in resource_ids:
+    def fetch_resource(rid):
+        # 抓取并清洗单个年度资源, 失败或无坐标字段时返回 None
         params = {"resource_id": rid, "limit": 10000}
         try:
-            response = requests.get(url, params=params, timeout=10)
-            data = response.json()
+            response = _SESSION.get(url, params=params, timeout=10)
+            data = orjson.loads(response.content)
             
             if 'result' in data and 'records' in data['result']:
                 df = pd.DataFrame(data['result']['records'])
-                
-                # 字段名映射
-                rename_map = {
-                    '緯度': 'latitude', '纬度': 'latitude', 'Lat': 'latitude', 'LAT': 'latitude',
-                    '経度': 'longitude', '经度': 'longitude', 'Lon': 'longitude', 'LON': 'longitude',
-                    '年月日': 'sighting_datetime', '発生日時': 'sighting_datetime', 'Date': 'sighting_datetime'
-                }
                 df = df.rename(columns=rename_map)
                 
                 if 'latitude' in df.columns and 'longitude' in df.columns:
@@ -53,37 +151,73 @@ def load_yamanashi_data():
                     df = df.dropna(subset=['latitude', 'longitude'])
                     
                     if 'sighting_datetime' in df.columns:
-                        df['sighting_datetime'] = pd.to_datetime(df['sighting_datetime'], errors='coerce')
+                        df['sighting_datetime'] = parse_sighting_datetimes(df['sighting_datetime'])
                     else:
                         df['sighting_datetime'] = pd.NaT
 
-                    # 描述构建
-                    def make_description(row):
-                        parts = []
-                        possible_cols = ['目撃市町村', '場所', '住所', '詳細', '状況']
-                        for col in possible_cols:
-                            val = str(row.get(col, ''))
-                            if val and val != 'nan':
-                                parts.append(val)
-                        return " ".join(parts) if parts else "无描述"
-                    
-                    df['sighting_condition'] = df.apply(make_description, axis=1)
+                    # 描述构建 (按列向量化拼接, 跳过空值)
+                    # 先 fillna 再转字符串: pandas 3 的 str 列 astype(str) 会保留 NaN, 拼接后整行变成 <NA>
+                    desc = pd.Series('', index=df.index, dtype=object)
+                    for col in desc_cols:
+                        if col not in df.columns:
+                            continue
+                        val = df[col].fillna('').astype(str)
+                        val = val.where((val != '') & (val != 'nan'), '')
+                        both = (desc != '') & (val != '')
+                        desc = (desc + ' ' + val).where(both, desc + val)
+                    df['sighting_condition'] = desc.where(desc != '', '无描述')
                     
                     clean_df = df[['latitude', 'longitude', 'sighting_datetime', 'sighting_condition']]
-                    all_frames.append(clean_df)
+                    return clean_df
                     
         except Exception as e:
-            continue
+            pass
+        return None
+
+    # 各年度资源互不依赖, 并发请求: 总耗时约等于最慢的一次而不是三次之和
+    with ThreadPoolExecutor(max_workers=len(resource_ids)) as pool:
+        all_frames = [f for f in pool.map(fetch_resource, resource_ids) if f is not None]
 
     if all_frames:
         final_df = pd.concat(all_frames, ignore_index=True)
+        # 坐标用 float32 (约 1 米精度, 远小于预警距离), 文本列改用 Arrow 连续存储, 省内存且 Parquet 读写零转换
+        final_df = final_df.astype({'latitude': 'float32', 'longitude': 'float32'})
+        final_df['sighting_condition'] = final_df['sighting_condition'].astype('string[pyarrow]')
+        # 只有全部年度都抓取成功才写快照, 免得某个资源的临时故障被固化到磁盘 24 小时
+        if len(all_frames) == len(resource_ids):
+            write_snapshot(final_df)
         return final_df
     else:
-        return pd.DataFrame()
+        # API 整体不可用时退回过期快照, 总比没有数据好
+        stale = read_snapshot()
+        return stale if stale is not None else pd.DataFrame()
+
+# 局部等距投影 (以山梨县为中心): 经纬度 -> 米, 缓冲半径按真实距离计算
+PROJ_LON0, PROJ_LAT0 = 138.5, 35.6
+M_PER_DEG_LAT = 110574.0
+M_PER_DEG_LON = 111320.0 * np.cos(np.radians(PROJ_LAT0))
+
+def to_local_xy(lon, lat):
+    x = (np.asarray(lon, dtype=np.float64) - PROJ_LON0) * M_PER_DEG_LON
+    y = (np.asarray(lat, dtype=np.float64) - PROJ_LAT0) * M_PER_DEG_LAT
+    return x, y
+
+@st.cache_resource(ttl=SNAPSHOT_MAX_AGE)
+def load_bear_catalog():
+    # 全量记录 + 空间索引 (STRtree, 米制坐标, 行号与 df 的位置一一对应) + 时间范围
+    # cache_resource 按引用共享, 每次重跑不再反序列化/哈希整张表; 下游只读不改
+    # 时间范围只在加载时算一次, 侧边栏每次重跑直接使用
+    df = load_yamanashi_data()
+    if df.empty:
+        return df, None, (None, None)
+    # 索引建在 float32 取整后的坐标上, to_local_xy 升为 float64 也找不回丢掉的精度; 误差约 1 米, 可接受
+    x, y = to_local_xy(df['longitude'].to_numpy(), df['latitude'].to_numpy())
+    return df, shapely.STRtree(shapely.points(x, y)), date_bounds(df)
 
 # 加载原始全量数据
-all_bears = load_yamanashi_data()
+all_bears, bear_index, (min_date, max_date) = load_bear_catalog()
 if all_bears.empty:
+    load_bear_catalog.clear()  # 不缓存空结果, 下次重跑重新尝试
     st.error("❌ 数据库加载失败")
     st.stop()
 
@@ -98,38 +232,37 @@ with col1:
 with col2:
     st.subheader("⚙️ 检测设置")
     
-    # --- 新增功能：时间范围筛选 ---
-    # 获取数据中的最早和最晚时间
-    valid_dates = all_bears['sighting_datetime'].dropna()
-    if not valid_dates.empty:
-        min_date = valid_dates.min().date()
-        max_date = valid_dates.max().date()
-        
-        # 默认选中全量时间，让用户自己缩小
-        date_range = st.date_input(
-            "📅 时间范围筛选",
-            value=(min_date, max_date),
-            min_value=min_date,
-            max_value=max_date,
-            help="只检测该时间段内的熊出没记录"
-        )
+    # 表单内的控件调整不会立即触发重跑, 点击「应用」后统一生效
+    with st.form("detect_settings"):
+        # --- 新增功能：时间范围筛选 ---
+        # 获取数据中的最早和最晚时间
+        if min_date is not None:
+            # 默认选中全量时间，让用户自己缩小
+            date_range = st.date_input(
+                "📅 时间范围筛选",
+                value=(min_date, max_date),
+                min_value=min_date,
+                max_value=max_date,
+                help="只检测该时间段内的熊出没记录"
+            )
         
-        # 处理筛选逻辑
-        if len(date_range) == 2:
-            start_d, end_d = date_range
-            # 生成筛选后的数据表
-            bears_to_check = all_bears[
-                (all_bears['sighting_datetime'].dt.date >= start_d) & 
-                (all_bears['sighting_datetime'].dt.date <= end_d)
-            ]
+            # 处理筛选逻辑
+            if len(date_range) == 2:
+                start_d, end_d = date_range
+                # 生成筛选后的数据表 (直接比较 datetime64, 避免逐行生成 date 对象)
+                sighting_dt = all_bears['sighting_datetime']
+                start_ts = pd.Timestamp(start_d, tz=sighting_dt.dt.tz)
+                end_ts = pd.Timestamp(end_d, tz=sighting_dt.dt.tz) + pd.Timedelta(days=1)
+                bears_to_check = all_bears[(sighting_dt >= start_ts) & (sighting_dt < end_ts)]
+            else:
+                bears_to_check = all_bears
         else:
+            st.warning("数据中缺少时间信息，无法筛选。")
             bears_to_check = all_bears
-    else:
-        st.warning("数据中缺少时间信息，无法筛选。")
-        bears_to_check = all_bears
 
-    # --- 预警距离设置 ---
-    buffer_radius_m = st.slider("📏 预警距离 (米)", 100, 5000, 500, 100)
+        # --- 预警距离设置 ---
+        buffer_radius_m = st.slider("📏 预警距离 (米)", 100, 5000, 500, 100)
+        st.form_submit_button("✅ 应用设置", use_container_width=True)
     
     # 显示当前生效的数据量
     st.caption(f"🔍 当前生效记录: {len(bears_to_check)} 条 (总计: {len(all_bears)})")
@@ -139,65 +272,104 @@ with col2:
 # ==========================================
 # 3. 处理逻辑
 # ==========================================
+# 危险点由前端 JS 批量生成: row = [lat, lon, 日期]
+DANGER_MARKER_JS = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.setIcon(L.AwesomeMarkers.icon({icon: 'info-sign', markerColor: 'red', prefix: 'glyphicon'}));
+    marker.bindPopup('⚠️ ' + row[2]);
+    return marker;
+}
+"""
+
+def parse_gpx_points(gpx_file):
+    """提取 GPX 坐标, 返回 (N, 2) 的 [lat, lon] 数组; 优先轨迹点, 没有轨迹时退回路线点"""
+    try:
+        # 快速路径: 流式解析, 只读取 trkpt/rtept 的 lat/lon 属性 (兼容 GPX 1.0/1.1 命名空间)
+        track_pts, route_pts = [], []
+        for _, elem in ET.iterparse(gpx_file):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if tag == 'trkpt':
+                track_pts.append((float(elem.get('lat')), float(elem.get('lon'))))
+                elem.clear()
+            elif tag == 'rtept':
+                route_pts.append((float(elem.get('lat')), float(elem.get('lon'))))
+                elem.clear()
+        points = track_pts or route_pts
+    except (ET.ParseError, TypeError, ValueError):
+        # 非标准文件交给 gpxpy 兜底
+        gpx_file.seek(0)
+        gpx = gpxpy.parse(gpx_file)
+        points = [(p.latitude, p.longitude) for t in gpx.tracks for seg in t.segments for p in seg.points]
+        points = points or [(p.latitude, p.longitude) for r in gpx.routes for p in r.points]
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def load_gpx_route(gpx_bytes):
+    """解析 GPX, 返回 (坐标数组, 米制路线); 只依赖文件内容, 调整预警距离时不会重新解析"""
+    points = parse_gpx_points(io.BytesIO(gpx_bytes))
+    if len(points) == 0:
+        return points, None
+    # 检测在米制坐标下进行, 预警距离是到路线的真实距离 (不再用 /90000 近似换算度数)
+    x, y = to_local_xy(points[:, 1], points[:, 0])
+    return points, LineString(np.column_stack([x, y]))
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def build_route_geometry(gpx_bytes, buffer_radius_m):
+    """返回 (抽稀后的粗筛路线, 抽稀容差); 完整路线由 load_gpx_route 缓存, 这里不再按半径各存一份"""
+    _, route_line_m = load_gpx_route(gpx_bytes)
+    if route_line_m is None:
+        return None, 0.0
+    # Douglas-Peucker 抽稀: 偏差不超过半径的 1/10, 顶点数大幅减少; 只用于粗筛, 精确判断仍用原路线
+    tolerance = buffer_radius_m / 10
+    return route_line_m.simplify(tolerance, preserve_topology=False), tolerance
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def render_route_map(points, marker_data):
+    """生成路线地图 HTML; 路线和危险点都没变时 (如重复提交相同设置) 直接复用"""
+    start_lat, start_lon = points[0]
+    m = folium.Map(location=[start_lat, start_lon], zoom_start=12, tiles="OpenStreetMap")
+    
+    # 画路线
+    folium.PolyLine(points.tolist(), color="blue", weight=5, opacity=0.7).add_to(m)
+    
+    # 绘制危险点 (整体传入坐标数组, 不逐个创建 Marker)
+    if marker_data:
+        FastMarkerCluster(marker_data, callback=DANGER_MARKER_JS).add_to(m)
+    
+    # folium 需要 [[南, 西], [北, 东]]
+    m.fit_bounds([points.min(axis=0).tolist(), points.max(axis=0).tolist()])
+    return m.get_root().render()
+
 map_html = ""
-danger_list = []
+danger_df = pd.DataFrame()
 points_count = 0
 
 if uploaded_file:
     try:
-        gpx = gpxpy.parse(uploaded_file)
-        points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    points.append((point.latitude, point.longitude))
-        if not points:
-            for route in gpx.routes:
-                for point in route.points:
-                    points.append((point.latitude, point.longitude))
+        gpx_bytes = uploaded_file.getvalue()
+        points, route_line_m = load_gpx_route(gpx_bytes)
         
         points_count = len(points)
         
         if points_count > 0:
-            # 初始化地图
-            start_lat, start_lon = points[0]
-            m = folium.Map(location=[start_lat, start_lon], zoom_start=12, tiles="OpenStreetMap")
-            
-            # 1. 画路线
-            folium.PolyLine(points, color="blue", weight=5, opacity=0.7).add_to(m)
-            
-            # 2. 缓冲区计算
-            line_points = [(p[1], p[0]) for p in points] # Shapely (Lon, Lat)
-            route_line = LineString(line_points)
-            deg_buffer = buffer_radius_m / 90000.0
-            route_buffer = route_line.buffer(deg_buffer)
-            
-            # 3. 粗筛 (使用 bears_to_check 即筛选后的数据)
-            min_x, min_y, max_x, max_y = route_buffer.bounds
-            candidates = bears_to_check[
-                (bears_to_check['longitude'] >= min_x - 0.05) & 
-                (bears_to_check['longitude'] <= max_x + 0.05) &
-                (bears_to_check['latitude'] >= min_y - 0.05) & 
-                (bears_to_check['latitude'] <= max_y + 0.05)
-            ]
-            
-            # 4. 精筛与绘图
-            for idx, row in candidates.iterrows():
-                b_lat = float(row['latitude'])
-                b_lon = float(row['longitude'])
-                bear_pt = Point(b_lon, b_lat)
-                
-                if route_buffer.contains(bear_pt):
-                    danger_list.append(row)
-                    
-                    folium.Marker(
-                        location=[b_lat, b_lon],
-                        popup=f"⚠️ {str(row['sighting_datetime'])[:10]}",
-                        icon=folium.Icon(color='red', icon='info-sign')
-                    ).add_to(m)
-            
-            m.fit_bounds(route_line.bounds)
-            map_html = m._repr_html_()
+            coarse_line_m, tolerance = build_route_geometry(gpx_bytes, buffer_radius_m)
+            # 1. 空间索引查询: 抽稀路线偏离原路线最多 tolerance, 粗筛距离放宽同样的量保证不漏点,
+            #    候选点再按到原路线的真实距离精确判断 (无需构建缓冲多边形)
+            candidates = bear_index.query(coarse_line_m, predicate='dwithin', distance=buffer_radius_m + tolerance)
+            exact = shapely.dwithin(bear_index.geometries.take(candidates), route_line_m, buffer_radius_m)
+            hit_idx = candidates[exact]
+            danger_df = all_bears.iloc[hit_idx]
+            # 只保留时间筛选范围内的记录
+            danger_df = danger_df[danger_df.index.isin(bears_to_check.index)]
+
+            # 2. 生成地图
+            marker_data = list(zip(
+                danger_df['latitude'].tolist(),
+                danger_df['longitude'].tolist(),
+                danger_df['sighting_datetime'].astype(str).str[:10].tolist()
+            ))
+            map_html = render_route_map(points, marker_data)
             
         else:
             st.warning("GPX 解析成功但无坐标点。")
@@ -213,17 +385,17 @@ with col1:
         components.html(map_html, height=600)
     else:
         m_empty = folium.Map(location=[35.6, 138.5], zoom_start=10)
-        components.html(m_empty._repr_html_(), height=600)
+        components.html(m_empty.get_root().render(), height=600)
 
 with col2:
     if uploaded_file:
         if points_count > 0:
             st.markdown("#### 📊 检测报告")
             
-            if danger_list:
-                st.error(f"🔴 发现 {len(danger_list)} 个危险点 (范围: {buffer_radius_m}米)")
+            if not danger_df.empty:
+                st.error(f"🔴 发现 {len(danger_df)} 个危险点 (范围: {buffer_radius_m}米)")
                 
-                res_df = pd.DataFrame(danger_list).sort_values('sighting_datetime', ascending=False)
+                res_df = danger_df.sort_values('sighting_datetime', ascending=False)
                 
                 st.dataframe(
                     res_df[['sighting_datetime', 'sighting_condition']],